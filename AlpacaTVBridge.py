@@ -3,13 +3,18 @@ from alpaca.common.exceptions import APIError
 from waitress import serve
 from getKeys import getKeys
 from alpaca.trading.client import TradingClient
+from alpaca.trading.stream import TradingStream
 from alpaca.trading.requests import (
     MarketOrderRequest,
     GetOrdersRequest,
     LimitOrderRequest,
 )
 from alpaca.trading.enums import OrderSide, TimeInForce
-import os, logging, re, time, sys, json
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import os, logging, re, time, sys, json, threading, queue, weakref
 
 
 try:
@@ -40,6 +45,158 @@ account = getKeys(options["using"])
 accountReal = getKeys("realTrading")
 accountPaper = getKeys("paperTrading")
 
+
+class RateLimiter:
+    """Sliding window limiting calls to 'rate' per 'per' seconds. acquire() blocks until a call is allowed."""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        # Times of the calls made within the last 'per' seconds.
+        self.window = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.window and now - self.window[0] >= self.per:
+                    self.window.popleft()
+                if len(self.window) < self.rate:
+                    self.window.append(now)
+                    return
+                # Wait until the oldest call leaves the window.
+                wait = self.per - (now - self.window[0])
+            time.sleep(wait)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """Http adapter that waits on a RateLimiter before sending each request."""
+
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+def rateLimit(tradingClient, rate=200, per=60):
+    # Keeps a client's requests under Alpaca's api rate limit (200 per minute per account) so a burst of alerts
+    # gets spread out instead of failing with 429 errors.
+    # Note: _session is part of alpaca-py 0.12's RESTClient internals (pinned in requirements.txt). Verify it still
+    # exists when upgrading alpaca-py or the limiter won't be applied.
+    tradingClient._session.mount("https://", RateLimitedAdapter(RateLimiter(rate, per)))
+    return tradingClient
+
+
+# Trading clients are created once and shared between requests so the underlying http session (and its
+# connections to Alpaca) gets reused instead of being rebuilt for every webhook.
+clientReal = rateLimit(TradingClient(**accountReal))
+clientPaper = rateLimit(TradingClient(**accountPaper))
+client = clientPaper if account["paper"] else clientReal
+
+
+# Account info is cached per client for accountCacheTime seconds since the cash balance only changes when orders
+# fill. Cleared by the trade update stream when an order fills and after submitting an order. Clients are weakly
+# referenced so test clients aren't kept alive by the cache.
+accountCacheTime = 2
+accountCache = weakref.WeakKeyDictionary()
+accountCacheLock = threading.Lock()
+# Incremented when the cache is cleared so a request started before then doesn't store an outdated account.
+accountCacheGeneration = 0
+
+
+def getAccount(tradingClient):
+    # Returns the cached account for the client or retrieves it if it's expired.
+    with accountCacheLock:
+        cached = accountCache.get(tradingClient)
+        generation = accountCacheGeneration
+    if cached and time.monotonic() - cached[0] <= accountCacheTime:
+        return cached[1]
+    acct = tradingClient.get_account()
+    with accountCacheLock:
+        if generation == accountCacheGeneration:
+            accountCache[tradingClient] = (time.monotonic(), acct)
+    return acct
+
+
+def clearAccountCache():
+    global accountCacheGeneration
+    with accountCacheLock:
+        accountCache.clear()
+        accountCacheGeneration += 1
+
+
+class OrderUpdates:
+    """Keeps the latest state of orders from Alpaca's trade update stream so orders can be verified without
+    polling. Streams are started per client with start() and run in daemon threads.
+    """
+
+    # Max number of orders to keep track of. Oldest are dropped first.
+    maxOrders = 500
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.orders = OrderedDict()
+        self.streams = {}
+
+    def start(self, tradingClient, keys):
+        # Subscribe to trade updates for the account the client uses.
+        if tradingClient in self.streams:
+            return
+        stream = TradingStream(keys["api_key"], keys["secret_key"], paper=keys["paper"])
+        stream.subscribe_trade_updates(self.tradeUpdate)
+        thread = threading.Thread(target=stream.run, daemon=True)
+        thread.start()
+        self.streams[tradingClient] = (stream, thread)
+
+    def listening(self, tradingClient):
+        # True only while the stream thread is alive and connected. TradingStream sets _running (alpaca-py 0.12
+        # internals, pinned in requirements.txt) once it's authenticated and subscribed, and clears it while
+        # reconnecting. Updates missed in the meantime aren't replayed so orders are checked directly otherwise.
+        if tradingClient not in self.streams:
+            return False
+        stream, thread = self.streams[tradingClient]
+        return thread.is_alive() and getattr(stream, "_running", False)
+
+    async def tradeUpdate(self, data):
+        # Fills change the cash balance.
+        if data.event in ("fill", "partial_fill"):
+            clearAccountCache()
+        with self.condition:
+            self.orders[data.order.client_order_id] = data.order
+            self.orders.move_to_end(data.order.client_order_id)
+            while len(self.orders) > self.maxOrders:
+                self.orders.popitem(last=False)
+            self.condition.notify_all()
+
+    @staticmethod
+    def done(order):
+        # Order exited in 1 of 3 ways (cancel, fail, fill).
+        return (
+            order.filled_at is not None
+            or order.failed_at is not None
+            or order.canceled_at is not None
+        )
+
+    def wait(self, id, timeout):
+        # Waits until the order is done or timeout (seconds). Returns the order if it's done, otherwise None.
+        with self.condition:
+            if self.condition.wait_for(
+                lambda: id in self.orders and self.done(self.orders[id]), timeout
+            ):
+                return self.orders[id]
+        return None
+
+    def forget(self, id):
+        with self.condition:
+            self.orders.pop(id, None)
+
+
+orderUpdates = OrderUpdates()
+
 # Load stocks initially
 # path = os.path.dirname(__file__)
 # with open(path + os.sep + "Data/stocks.json", "r") as f:
@@ -63,12 +220,10 @@ except FileNotFoundError:
 # Load settings
 def loadSettings(paper, real, using):
     settings = paper.copy()
-    for i in real.keys():
-        try:
-            settings[i]
-        except:
-            err = f"realTrading/paperTrading setting name discrepancy: '{i}' item in 'realTraing' settings. Please fix the spelling or remove it from realTrading settings."
-            raise Exception(err)
+    missing = set(real.keys()) - set(paper.keys())
+    if missing:
+        err = f"realTrading/paperTrading setting name discrepancy: {sorted(missing)} item(s) in 'realTraing' settings. Please fix the spelling or remove it from realTrading settings."
+        raise Exception(err)
     if using != "paperTrading":
         settings.update(options["realTrading"])
     return settings
@@ -84,6 +239,19 @@ settingsPaper = loadSettings(
     options["paperTrading"], options["realTrading"], "paperTrading"
 )
 
+# Options used by AutomatedTrader for each account. Built once and copied for each request.
+defaultOptions = {
+    # Gets open potisions for specific stock to verify ordering. Multiple buys before selling not implemented yet.
+    "positions": [],
+    # Gets all open positions.
+    "allPositions": [],
+    # Retrieves open orders is there are any for the symbol requested.
+    "orders": [],
+}
+traderOptions = {**defaultOptions, **settings}
+traderOptionsReal = {**defaultOptions, **settingsReal}
+traderOptionsPaper = {**defaultOptions, **settingsPaper}
+
 # Check for configuration conflict that could cause unintended buying or errors.
 if settings["enabled"] and settings["testMode"] and options["using"] == "realTrading":
     err = "testMode and real money keys being used, exiting. Change one or the other."
@@ -96,6 +264,14 @@ elif settings["fractional"] and settings["limit"]:
 
 app = Flask(__name__)
 
+# Compiled once at import since it's used on every webhook. Matches either a Lorentzian Classification alert
+# (groups 1-4, must start with "LDC") or a custom order alert (groups 5-7). See setData for details.
+_REQUEST_RE = re.compile(
+    rb"\ALDC.*?(bear|bull|open|close).+?(long|short)?.+[|] (.+)[@]\[*([0-9.]+)\]* [|]"
+    rb"|order (buy|sell) [|] (.+)[@]\[*([0-9.]+)\]* [|]",
+    re.IGNORECASE,
+)
+
 # data examples from pine script strategy alerts:
 # Compatible with 'Machine Learning: Lorentzian Classification' indicator alerts
 # LDC Kernel Bullish ▲ | CLSK@4.015 | (1)...
@@ -104,32 +280,70 @@ app = Flask(__name__)
 
 
 def acctInfo():
-    temp = TradingClient(**account).get_account()
-    print(f'***account: {"PAPER" if account["paper"] else "REAL MONEY"}')
-    print(f"status: {temp.status}")
-    print(f"account blocked: {temp.account_blocked}")
-    print(f"trade_suspended_by_user: {temp.trade_suspended_by_user}")
-    print(f"trading_blocked: {temp.trading_blocked}")
-    print(f"transfers_blocked: {temp.transfers_blocked}")
-    print(f"equity: {temp.equity}")
-    print(f"currency: {temp.currency}")
-    print(f"cash: {temp.cash}")
-    print(f"buying_power: {temp.buying_power}")
-    print(f"daytrading_buying_power: {temp.daytrading_buying_power}")
-    print(f"shorting_enabled: {temp.shorting_enabled}")
-    print(f"crypto_status: {temp.crypto_status}")
+    temp = client.get_account()
     try:
-        print(f"Program argurment: {sys.argv[1]}")
-    except:
-        print(f"Program argurment: None")
-    print("-------------------------------------------------")
+        argument = sys.argv[1]
+    except IndexError:
+        argument = None
+    info = (
+        f'***account: {"PAPER" if account["paper"] else "REAL MONEY"}\n'
+        f"status: {temp.status}\n"
+        f"account blocked: {temp.account_blocked}\n"
+        f"trade_suspended_by_user: {temp.trade_suspended_by_user}\n"
+        f"trading_blocked: {temp.trading_blocked}\n"
+        f"transfers_blocked: {temp.transfers_blocked}\n"
+        f"equity: {temp.equity}\n"
+        f"currency: {temp.currency}\n"
+        f"cash: {temp.cash}\n"
+        f"buying_power: {temp.buying_power}\n"
+        f"daytrading_buying_power: {temp.daytrading_buying_power}\n"
+        f"shorting_enabled: {temp.shorting_enabled}\n"
+        f"crypto_status: {temp.crypto_status}\n"
+        f"Program argurment: {argument}\n"
+        "-------------------------------------------------"
+    )
+    print(info)
+    logger.info("Account info:\n%s", info)
+
+
+# Webhooks are acknowledged right away and processed in the background so TradingView isn't left waiting on
+# Alpaca. Keep workerThreads at 1 to avoid overwriting the preference file (stocks.json) through get_stock_info.
+workerThreads = 1
+workQueue = queue.Queue()
+
+
+def worker():
+    # Processes requests from the queue until the program exits.
+    while True:
+        req_data = workQueue.get()
+        try:
+            AutomatedTrader(req=req_data)
+        except Exception as e:
+            logger.exception("Failed to process request: %s, error: %s", req_data, e)
+        finally:
+            workQueue.task_done()
+
+
+for _ in range(workerThreads):
+    threading.Thread(target=worker, daemon=True).start()
+
+
+@lru_cache(maxsize=256)
+def ordersRequest(symbol):
+    # Open orders request for a symbol. Cached since the request model is validated every time it's created and
+    # alerts usually repeat the same symbols.
+    return GetOrdersRequest(symbols=[symbol])
 
 
 @app.route("/", methods=["POST"])
 def respond():
-    req_data = str(request.data)
-    logger.info(f"Recieved request with data: {req_data}")
-    trader = AutomatedTrader(req=req_data)
+    req_data = request.get_data()
+    workQueue.put(req_data)
+    logger.info(
+        "Recieved request with data: %s, queue size: %s",
+        req_data,
+        workQueue.qsize(),
+    )
 
     return Response(status=200)
 
@@ -154,17 +368,6 @@ class AutomatedTrader:
         self.testStocklist = testStocklist
         self.testAccount = testAccount
         self.asset = None
-        self.options = {
-            # Gets open potisions for specific stock to verify ordering. Multiple buys before selling not implemented yet.
-            "positions": [],
-            # Gets all open positions.
-            "allPositions": [],
-            # Retrieves open orders is there are any for the symbol requested.
-            "orders": [],
-            # Gets all the open orders.
-            "allOrders": [],
-        }
-
         # Set request data and stock info.
         self.req = req
         self.setData()
@@ -173,19 +376,15 @@ class AutomatedTrader:
         # Use settings if they were imported successfully. More of a debug test since it fails if it's not there and it should be there.
         # self.options.update(settings)
         self.client = self.createClientAndSettings()
-        # Count the items in options and if newOptions increases it, raise an exception.
-        optCnt = len(self.options)
-        self.options.update(newOptions)
-        if len(self.options) != optCnt:
+        # Raise an exception if newOptions has keys that aren't in options.
+        if newOptions.keys() - self.options.keys():
             raise Exception(
                 "Extra options found. Verify newOption keys match option keys"
             )
+        self.options.update(newOptions)
         # Verify 'enabled' option is True. Used primarily for unittesting.
         if self.options["enabled"]:
-            self.setOrders()
-            self.setPosition()
-            self.setAllPositions()
-            self.setBalance()
+            self.setAccountData()
             self.createOrder()
 
     def __del__(self):
@@ -197,87 +396,85 @@ class AutomatedTrader:
         # Creates the trading client based on real or paper account for testing purposes.
         if self.testAccount != None:
             # For testing purposes
-            (
-                self.options.update(settingsPaper)
-                if self.testAccount["paper"]
-                else self.options.update(settingsReal)
+            self.options = dict(
+                traderOptionsPaper if self.testAccount["paper"] else traderOptionsReal
             )
             return TradingClient(**self.testAccount)
         elif not settings["perStockPreference"]:
             # Use account in settings if "perStockPreference" is False
-            self.options.update(settings)
-            return TradingClient(**account)
+            self.options = dict(traderOptions)
+            return client
 
         try:
             # Checks stocks.json to see if there is a preference if "perStockPreference" is True.
             if self.asset["account"] == "":
-                self.options.update(settings)
-                return TradingClient(**account)
+                self.options = dict(traderOptions)
+                return client
             elif self.asset["account"].upper() == "real".upper():
-                self.options.update(settingsReal)
-                return TradingClient(**accountReal)
+                self.options = dict(traderOptionsReal)
+                return clientReal
             elif self.asset["account"].upper() == "paper".upper():
-                self.options.update(settingsPaper)
-                return TradingClient(**accountPaper)
+                self.options = dict(traderOptionsPaper)
+                return clientPaper
             else:
                 logger.warning(
-                    f'Invalid stock account setting in stocks.json: {self.data["stock"]}. Defaulting to user settings.'
+                    "Invalid stock account setting in stocks.json: %s. Defaulting to user settings.",
+                    self.data["stock"],
                 )
-                self.options.update(settings)
-                return TradingClient(**account)
+                self.options = dict(traderOptions)
+                return client
         except TypeError:
             # Use account in settings if stock not found in stocks.json
-            self.options.update(settings)
-            return TradingClient(**account)
+            self.options = dict(traderOptions)
+            return client
 
     def setData(self):
         # requests parsed for either Machine Learning: Lorentzian
         # Classification or custom alerts (noted in documentation how to setup).
-        if self.req[:3] == "LDC":
-            extractedData = re.search(
-                # regex with ignorecase
-                r"(bear|bull|open|close).+?(long|short)?.+[|] (.+)[@]\[*([0-9.]+)\]* [|]",
-                self.req,
-                flags=re.IGNORECASE,
-            )
-        else:
-            extractedData = re.search(
-                # regex with ignorecase
-                r"order (buy|sell) [|] (.+)[@]\[*([0-9.]+)\]* [|]",
-                self.req,
-                flags=re.IGNORECASE,
-            )
+        # Requests are matched as bytes (as received by the webhook). Strings are encoded first. Surrounding
+        # whitespace is removed since LDC alerts have to start with "LDC".
+        req = self.req.encode() if isinstance(self.req, str) else self.req
+        req = req.strip()
+        extractedData = _REQUEST_RE.search(req)
         if extractedData == None:
-            logger.error(f"Failed to extract incoming request data: {self.req}")
+            logger.error("Failed to extract incoming request data: %s", self.req)
             raise Exception(f"Failed to extract incoming request data: {self.req}")
             # return Response(status=500)
-        elif len(extractedData.groups()) == 3:
-            self.data = {
-                "action": extractedData.group(1),
-                "position": None,
-                "stock": extractedData.group(2),
-                "price": float(extractedData.group(3)),
-            }
-        elif len(extractedData.groups()) == 4:
-            self.data = {
-                "action": extractedData.group(1),
-                "position": (
-                    extractedData.group(2).upper()
-                    if extractedData.group(2) != None
-                    else extractedData.group(2)
-                ),
-                "stock": extractedData.group(3),
-                "price": float(extractedData.group(4)),
-            }
+        groups = [x.decode() if x != None else x for x in extractedData.groups()]
+        if groups[0] != None:
+            # Lorentzian Classification alert
+            action, position, stock, price = groups[:4]
         else:
-            err = f"invalid webhook received: {self.req}"
-            logger.error(err)
-            print(err)
+            # Custom order alert
+            action, stock, price = groups[4:]
+            position = None
+        # action and position are lowercased so they can be compared without worrying about the alert's casing.
+        self.data = {
+            "action": action.lower(),
+            "position": position.lower() if position != None else position,
+            "stock": stock,
+            "price": float(price),
+        }
+
+    def setAccountData(self):
+        # Retrieves orders, positions, and balance at the same time since each one is a separate request to Alpaca.
+        # Total wait is the slowest request instead of all of them added together.
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                executor.submit(self.setOrders),
+                executor.submit(self.setPosition),
+                executor.submit(self.setAllPositions),
+                executor.submit(self.setBalance),
+            ]
+        # Raise any exception from the requests.
+        for future in futures:
+            future.result()
 
     def setOrders(self):
         # get open orders
-        stock = GetOrdersRequest(symbols=[self.data["stock"]])
-        self.options["orders"] = self.client.get_orders(stock)
+        self.options["orders"] = self.client.get_orders(
+            ordersRequest(self.data["stock"])
+        )
 
     def setStockInfo(self):
         if self.testStocklist:
@@ -310,7 +507,7 @@ class AutomatedTrader:
 
     def setBalance(self):
         # set balance at beginning and after each transaction
-        cash = float(self.client.get_account().cash)
+        cash = float(getAccount(self.client).cash)
         # nMBP = float(self.client.get_account().non_marginable_buying_power)
         acctBal = cash
         # acctBal = cash - (cash-nMBP)*2
@@ -329,7 +526,7 @@ class AutomatedTrader:
             self.options["balance"] = 100000
         # Check for negative balance.
         elif self.options["balance"] < 0:
-            logger.warning(f'Negative balance: {self.options["balance"]}')
+            logger.warning("Negative balance: %s", self.options["balance"])
             self.options["balance"] = 0
         # Check and set balace for set value per trade.
         elif self.options["buyPerc"] == 0 and self.options["buyAmt"] > 0:
@@ -364,103 +561,125 @@ class AutomatedTrader:
         )
 
         # Setup for buy/sell/open/close/bear/bull/short/long.
-        # Open a short position.
-        if self.data["action"] == "Open" and self.data["position"] == "Short".upper():
-            side = OrderSide.SELL
-            # Close if shorting not enabled. Need to adjust for positive and negative positions. Done?
-            if posQty < 0:
-                logger.debug(f'Already shorted for: {self.data["stock"]}')
-                amount = 0
-                return
-            if not self.options["short"] and posQty == 0:
-                logger.info(
-                    f'Shorting not enabled for: {self.data["stock"]}, {self.data["action"]}, {self.data["position"]}'
-                )
-                amount = 0
-            elif not self.options["short"] and posQty > 0:
-                logger.info(
-                    f'Selling all positions. Shorting not enabled for: {self.data["stock"]}, {self.data["action"]}, {self.data["position"]}'
-                )
-                amount = posQty
-            elif self.options["short"] and posQty > 0:
-                # Can't short with long positions so need to figure out how to sell to 0 then short and vice versa.
-                amount = posQty
-            elif self.options["short"] and posQty == 0:
-                pass
-            elif self.options["short"] and posQty < 0:
-                logger.info(
-                    f'Already shorted for: {self.data["stock"]}, {self.data["action"]}, {self.data["position"]}'
-                )
-                amount = 0
-                return
-        # Close a short position.
-        elif (
-            self.data["action"] == "Close" and self.data["position"] == "Short".upper()
-        ):
-            side = OrderSide.BUY
-            # Close positions for symbol
-            if posQty > 0:
-                logger.debug(
-                    f'Short not needed. Already long for: {self.data["stock"]}'
-                )
-                amount = 0
-                return
-            elif posQty == 0:
-                pass
-            elif posQty < 0:
-                amount = abs(posQty)
-        # Open a long position.
-        elif (
-            self.data["action"].upper() == "Bull".upper()
-            or self.data["action"].upper() == "buy".upper()
-            or self.data["action"].upper() == "Open".upper()
-        ) and (
-            self.data["position"] == "Long".upper() or self.data["position"] == None
-        ):
-            side = OrderSide.BUY
-            if self.options["positions"] != None:
-                amount = 0
-        # Close a long position.
-        elif (
-            self.data["action"].upper() == "Bear".upper()
-            or self.data["action"].upper() == "sell".upper()
-            or self.data["action"].upper() == "Close".upper()
-        ) and (
-            self.data["position"] == "Long".upper() or self.data["position"] == None
-        ):
-            side = OrderSide.SELL
-            # Close positions for symbol. Setting to 0 so it won't run if there's already a position.
-            amount = 0
-            if self.options["positions"] != None and posQty > 0:
-                amount += posQty
-            # need to add short depending if shorting is enabled. Not needed?
-            # if not self.options['short']:
-            #   logger.info(f'Shorting not enabled for: {self.data["stock"]}, action: {self.data["action"]}, price: {self.data["price"]}, quantity: {self.order_data.qty}')
-            #   return
+        handler = self.actions.get((self.data["action"], self.data["position"]))
         # Unhandled edge case.
-        else:
+        if handler is None:
             logger.error(
-                f'Unhandled Order: {self.data["stock"]}, action: {self.data["action"]}, price: {self.data["price"]}'
+                "Unhandled Order: %s, action: %s, price: %s",
+                self.data["stock"],
+                self.data["action"],
+                self.data["price"],
             )
             raise ValueError(
                 f'Unhandled action and/or position: {self.data["stock"]}, action: {self.data["action"]}, price: {self.data["price"]}'
             )
+        order = handler(self, posQty, amount)
+        # Nothing to order.
+        if order is None:
+            return
+        side, amount = order
 
         # return if 0 shares are to be bought. Basically not enough left over for buying 1 share or more
         if amount == 0:
             logger.info(
-                f'0 Orders requested: {self.data["stock"]}, action: {self.data["action"]}, price: {self.data["price"]}'
+                "0 Orders requested: %s, action: %s, price: %s",
+                self.data["stock"],
+                self.data["action"],
+                self.data["price"],
             )
             return
         # return if less then 0 shares are to be bought. Shouldn't happen right now
         elif amount < 0:
             logger.info(
-                f'<0 Orders requested: {self.data["stock"]}, {self.data["action"]}, {self.data["price"]}, amount: {amount}'
+                "<0 Orders requested: %s, %s, %s, amount: %s",
+                self.data["stock"],
+                self.data["action"],
+                self.data["price"],
+                amount,
             )
             return
         self.orderType(amount, side, self.options["limit"])
         return self.submitOrder()
 
+    # Handlers for each action and position. Each returns the side and amount to order, or None if no order
+    # should be made.
+    def openShort(self, posQty, amount):
+        # Open a short position.
+        side = OrderSide.SELL
+        # Close if shorting not enabled. Need to adjust for positive and negative positions. Done?
+        if posQty < 0:
+            logger.debug("Already shorted for: %s", self.data["stock"])
+            return
+        if not self.options["short"] and posQty == 0:
+            logger.info(
+                "Shorting not enabled for: %s, %s, %s",
+                self.data["stock"],
+                self.data["action"],
+                self.data["position"],
+            )
+            amount = 0
+        elif not self.options["short"] and posQty > 0:
+            logger.info(
+                "Selling all positions. Shorting not enabled for: %s, %s, %s",
+                self.data["stock"],
+                self.data["action"],
+                self.data["position"],
+            )
+            amount = posQty
+        elif self.options["short"] and posQty > 0:
+            # Can't short with long positions so need to figure out how to sell to 0 then short and vice versa.
+            amount = posQty
+        return side, amount
+
+    def closeShort(self, posQty, amount):
+        # Close a short position.
+        side = OrderSide.BUY
+        # Close positions for symbol
+        if posQty > 0:
+            logger.debug("Short not needed. Already long for: %s", self.data["stock"])
+            return
+        elif posQty < 0:
+            amount = abs(posQty)
+        return side, amount
+
+    def openLong(self, posQty, amount):
+        # Open a long position.
+        side = OrderSide.BUY
+        if self.options["positions"] != None:
+            amount = 0
+        return side, amount
+
+    def closeLong(self, posQty, amount):
+        # Close a long position.
+        side = OrderSide.SELL
+        # Close positions for symbol. Setting to 0 so it won't run if there's already a position.
+        amount = 0
+        if self.options["positions"] != None and posQty > 0:
+            amount += posQty
+        # need to add short depending if shorting is enabled. Not needed?
+        # if not self.options['short']:
+        #   logger.info(f'Shorting not enabled for: {self.data["stock"]}, action: {self.data["action"]}, price: {self.data["price"]}, quantity: {self.order_data.qty}')
+        #   return
+        return side, amount
+
+    # (action, position) from the request to the handler used in createOrder.
+    actions = {
+        ("open", "short"): openShort,
+        ("close", "short"): closeShort,
+        ("bull", None): openLong,
+        ("bull", "long"): openLong,
+        ("buy", None): openLong,
+        ("buy", "long"): openLong,
+        ("open", None): openLong,
+        ("open", "long"): openLong,
+        ("bear", None): closeLong,
+        ("bear", "long"): closeLong,
+        ("sell", None): closeLong,
+        ("sell", "long"): closeLong,
+        ("close", None): closeLong,
+        ("close", "long"): closeLong,
+    }
+
     def orderType(self, amount, side, limit):
         # Setup buy/sell order
         # Determine if using fractional amount of shares to buy.
@@ -538,14 +757,22 @@ class AutomatedTrader:
                 # return False
             elif len(self.options["allPositions"]) == self.options["maxPositions"]:
                 logger.info(
-                    f'At Max Positions. Order not created for: {self.data["stock"]}, {self.data["action"]}, {self.data["position"]}'
+                    "At Max Positions. Order not created for: %s, %s, %s",
+                    self.data["stock"],
+                    self.data["action"],
+                    self.data["position"],
                 )
                 return "Max Positions"
 
         # escape and don't actually submit order if not enabled. For debugging/testing purposes.
         if not self.options["enabled"]:
             logger.debug(
-                f'Not enabled, order not placed for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
+                "Not enabled, order not placed for: %s, action: %s %s, price: %s, quantity: %s",
+                self.data["stock"],
+                self.data["action"],
+                self.order_data.type._value_,
+                self.data["price"],
+                self.order_data.qty,
             )
             return "Not enabled"
 
@@ -563,6 +790,8 @@ class AutomatedTrader:
                 self.order = self.client.submit_order(self.order_data)
             else:
                 raise Exception(e._error)
+        # Balance will change once the order fills.
+        clearAccountCache()
         # Verifies option is enabled and asset exists in stocks.json. Loads the amount to newOrders. self.asset will be None if it isn't found in the stocklist so it won't cause an error.
         if (
             self.options["perStockAmountCompounding"]
@@ -584,12 +813,15 @@ class AutomatedTrader:
         if bool(self.newOrders):
             self.updateStockAmount()
 
-    def verifyOrder(self, order=None, timeout=False):
-        # Verify order exited in 1 of 3 ways (cancel, fail, fill).
-        orderSideBuy = str(order.side) == "OrderSide.BUY"
-        orderSideSell = str(order.side) == "OrderSide.SELL"
+    def verifyOrder(self, order=None):
+        # Verify order exited in 1 of 3 ways (cancel, fail, fill). Handled as a state machine:
+        #   pending -> done when the order completes before maxTime.
+        #   pending -> canceling -> done for the "Cancel" timeout setting or after totalMaxTime.
+        #   pending -> canceling -> market -> done for the "Market" timeout setting.
+        orderSideBuy = order.side == OrderSide.BUY
+        orderSideSell = order.side == OrderSide.SELL
 
-        def amountUpdate():
+        def amountUpdate(order):
             try:
                 if order and self.newOrders["amount"] > 0:
                     if order.filled_avg_price and orderSideBuy:
@@ -598,7 +830,8 @@ class AutomatedTrader:
                         )
                         if self.newOrders["amount"] <= 0:
                             logger.warning(
-                                f"Price differential causing overspending for: {self.order.symbol}"
+                                "Price differential causing overspending for: %s",
+                                self.order.symbol,
                             )
                             self.newOrders["amount"] = 0.01
                         if self.newOrders["amount"] == 0:
@@ -614,125 +847,208 @@ class AutomatedTrader:
             except KeyError:
                 pass
 
-        # TODO: Need to add async stream method for checking for order completion.
+        def cancel(order):
+            # Cancels the pending order and refreshes its status to speed up verifying it.
+            self.cancelOrderById(order.id.hex)
+            return self.client.get_order_by_client_id(order.client_order_id)
+
         maxTime = self.options["maxTime"]
         totalMaxTime = self.options["totalMaxTime"]
-        now = time.time()
-        id = order.client_order_id
-        # While loop that checks the order status every 1 second.
-        while (
-            order.filled_at is None
-            and order.failed_at is None
-            and order.canceled_at is None
-        ):
-            if time.time() - now > maxTime and not timeout:
-                logger.debug(
-                    f'Order exeeded max time ({maxTime} seconds) for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
-                )
-                # Cancels order after initial maxtime. Determined in settings
-                if (self.options["buyTimeout"] == "Cancel" and orderSideBuy) or (
-                    self.options["sellTimeout"] == "Cancel" and orderSideSell
-                ):
-                    # cancel pending order
-                    self.cancelOrderById(order.id.hex)
-                    # Refreshes status of order before verifying to speed up the process.
-                    order = self.client.get_order_by_client_id(id)
-                    timeout = True
-                    # verify canceled order
-                    if not self.verifyOrder(order, True):
-                        err = "cancel order failed"
-                        logger.debug(
-                            f'Order cancel failed for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
-                        )
+        # Buy or sell cancel preference after maxTime. Determined in settings.
+        timeoutSetting = (
+            self.options["buyTimeout"] if orderSideBuy else self.options["sellTimeout"]
+        )
+        state = "pending"
+        # Why the order is being canceled ("Cancel", "Market", or "totalMaxTime").
+        reason = None
+        while state != "done":
+            if state == "pending":
+                start = time.time()
+                order = self.waitForOrder(order, min(maxTime, totalMaxTime))
+                if OrderUpdates.done(order):
+                    return self.orderStatus(order, amountUpdate)
+                elif time.time() - start >= maxTime:
+                    logger.debug(
+                        "Order exceeded max time (%s seconds) for: %s, action: %s %s, price: %s, quantity: %s",
+                        maxTime,
+                        self.data["stock"],
+                        self.data["action"],
+                        self.order_data.type._value_,
+                        self.data["price"],
+                        self.order_data.qty,
+                    )
+                    if timeoutSetting not in ("Cancel", "Market"):
+                        err = "buy or sell timeout setting not found. Check the spelling in the settings and relaunch the server"
+                        self.cancelOrderById(order.id.hex)
+                        logger.error(err)
                         raise Exception(err)
-                    else:
-                        # competed at this point and returns True to indicate cancel was successful
-                        return True
-                # Changes order to market after initial maxtime by cancelling previous order and creating a new one.
-                # Determined in settings.
-                elif (self.options["buyTimeout"] == "Market" and orderSideBuy) or (
-                    self.options["sellTimeout"] == "Market" and orderSideSell
-                ):
-                    # cancel pending order
-                    self.cancelOrderById(order.id.hex)
-                    # Refreshes status of order before verifying to speed up the process.
-                    order = self.client.get_order_by_client_id(id)
-                    timeout = True
-                    # verify canceled order
-                    if self.verifyOrder(order, True):
-                        # Once order is canceled, find how many didn't get filled for new market order and append
-                        # filled qty to tracker.
-                        amountRemaining = float(order.qty) - float(order.filled_qty)
-                        # Set the new order. This will also set the new self.order_data based on the prior order info,
-                        # the updated amount left to buy/sell, and False for limit to make it a market order.
-                        self.orderType(amountRemaining, order.side, False)
-                        # Submit the order and udpate the local variable.
-                        order = self.client.submit_order(self.order_data)
+                    # Cancels order after initial maxtime. A "Market" setting then creates a new market order for
+                    # whatever didn't get filled.
+                    reason = timeoutSetting
+                else:
+                    # failsafe to exit loop
+                    logger.warning(
+                        "Cancelling, order exceeded totalMaxTime (%s seconds) for: action: %s %s, price: %s, quantity: %s",
+                        totalMaxTime,
+                        self.data["action"],
+                        self.order_data.type._value_,
+                        self.data["price"],
+                        self.order_data.qty,
+                    )
+                    reason = "totalMaxTime"
+                order = cancel(order)
+                state = "canceling"
+            elif state == "canceling":
+                # verify canceled order
+                order = self.waitForOrder(order, totalMaxTime)
+                canceled = OrderUpdates.done(order) and self.orderStatus(
+                    order, amountUpdate
+                )
+                if reason == "totalMaxTime":
+                    if canceled:
                         logger.debug(
-                            f'Timeout market order placed for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
+                            "maxTimeout order successfully canceled for: %s, action: %s %s, price: %s, quantity: %s",
+                            self.data["stock"],
+                            self.data["action"],
+                            self.order_data.type._value_,
+                            self.data["price"],
+                            self.order_data.qty,
                         )
-                        # Verify new order completion.
-                        if self.verifyOrder(order, True):
-                            logger.debug(
-                                f'Timeout market order succeeded for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
-                            )
-                            return True
-                        else:
-                            err = "market order failed"
-                            logger.debug(
-                                f'Timeout market order failed for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
-                            )
-                            return False
                     else:
-                        err = "cancel order failed"
                         logger.debug(
-                            f'Order cancel failed for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
+                            "Timeout market order failed for: %s, action: %s %s, price: %s, quantity: %s",
+                            self.data["stock"],
+                            self.data["action"],
+                            self.order_data.type._value_,
+                            self.data["price"],
+                            self.order_data.qty,
                         )
-                        raise Exception(err)
-                else:
-                    err = "buy or sell timeout setting not found. Check the spelling in the settings and relaunch the server"
-                    self.cancelOrderById(order.id.hex)
-                    logger.error(err)
+                    return False
+                elif not canceled:
+                    err = "cancel order failed"
+                    logger.debug(
+                        "Order cancel failed for: %s, action: %s %s, price: %s, quantity: %s",
+                        self.data["stock"],
+                        self.data["action"],
+                        self.order_data.type._value_,
+                        self.data["price"],
+                        self.order_data.qty,
+                    )
                     raise Exception(err)
-            elif time.time() - now > totalMaxTime:
-                # failsafe to exit loop
-                self.cancelOrderById(order.id.hex)
-                logger.warning(
-                    f'Cancelling, order exeeded totalMaxTime ({totalMaxTime} seconds) for: action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
+                elif reason == "Cancel":
+                    # competed at this point and returns True to indicate cancel was successful
+                    return True
+                elif (
+                    order.filled_at is not None
+                    or float(order.qty) - float(order.filled_qty) <= 0
+                ):
+                    # Order filled before the cancel went through so there's nothing left for a market order.
+                    return True
+                state = "market"
+            elif state == "market":
+                # Once order is canceled, find how many didn't get filled for new market order.
+                amountRemaining = float(order.qty) - float(order.filled_qty)
+                # Set the new order. This will also set the new self.order_data based on the prior order info,
+                # the updated amount left to buy/sell, and False for limit to make it a market order.
+                self.orderType(amountRemaining, order.side, False)
+                # Submit the order and udpate the local variable.
+                order = self.client.submit_order(self.order_data)
+                logger.debug(
+                    "Timeout market order placed for: %s, action: %s %s, price: %s, quantity: %s",
+                    self.data["stock"],
+                    self.data["action"],
+                    self.order_data.type._value_,
+                    self.data["price"],
+                    self.order_data.qty,
                 )
-                # Refreshes status of order before verifying to speed up the process.
-                order = self.client.get_order_by_client_id(id)
-                timeout = True
-                if self.verifyOrder(order, True):
+                # Verify new order completion. Cancels it if it isn't done by totalMaxTime.
+                order = self.waitForOrder(order, totalMaxTime)
+                if not OrderUpdates.done(order):
+                    logger.warning(
+                        "Cancelling, order exceeded totalMaxTime (%s seconds) for: action: %s %s, price: %s, quantity: %s",
+                        totalMaxTime,
+                        self.data["action"],
+                        self.order_data.type._value_,
+                        self.data["price"],
+                        self.order_data.qty,
+                    )
+                    order = cancel(order)
+                    reason = "totalMaxTime"
+                    state = "canceling"
+                elif self.orderStatus(order, amountUpdate):
                     logger.debug(
-                        f'maxTimeout order successfully canceled for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
+                        "Timeout market order succeeded for: %s, action: %s %s, price: %s, quantity: %s",
+                        self.data["stock"],
+                        self.data["action"],
+                        self.order_data.type._value_,
+                        self.data["price"],
+                        self.order_data.qty,
                     )
-                    return False
+                    return True
                 else:
-                    err = f'maxTimeout order cancel failed for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
                     logger.debug(
-                        f'Timeout market order failed for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
+                        "Timeout market order failed for: %s, action: %s %s, price: %s, quantity: %s",
+                        self.data["stock"],
+                        self.data["action"],
+                        self.order_data.type._value_,
+                        self.data["price"],
+                        self.order_data.qty,
                     )
                     return False
-            time.sleep(1)
-            order = self.client.get_order_by_client_id(id)
 
+    def waitForOrder(self, order, seconds):
+        # Waits up to the amount of seconds for the order to complete and returns the latest status of it. Uses the
+        # trade update stream if it's running for the client, otherwise checks the order status every 1 second.
+        id = order.client_order_id
+        end = time.time() + seconds
+        while not OrderUpdates.done(order) and time.time() < end:
+            if orderUpdates.listening(self.client):
+                update = orderUpdates.wait(id, max(end - time.time(), 0))
+                if update:
+                    order = update
+                else:
+                    # The stream doesn't replay missed updates (reconnects or orders completed before subscribing)
+                    # so refresh the order before deciding it timed out.
+                    order = self.client.get_order_by_client_id(id)
+            else:
+                time.sleep(1)
+                order = self.client.get_order_by_client_id(id)
+        return order
+
+    def orderStatus(self, order, amountUpdate):
+        # Logs how the order completed and updates the stock amount. Returns True if it was canceled or filled.
+        orderUpdates.forget(order.client_order_id)
         if order.canceled_at is not None:
-            amountUpdate()
+            amountUpdate(order)
             logger.info(
-                f'Order canceled for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
+                "Order canceled for: %s, action: %s %s, price: %s, quantity: %s",
+                self.data["stock"],
+                self.data["action"],
+                self.order_data.type._value_,
+                self.data["price"],
+                self.order_data.qty,
             )
             return True
         elif order.failed_at is not None:
-            amountUpdate()
+            amountUpdate(order)
             logger.warning(
-                f'Order failed for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
+                "Order failed for: %s, action: %s %s, price: %s, quantity: %s",
+                self.data["stock"],
+                self.data["action"],
+                self.order_data.type._value_,
+                self.data["price"],
+                self.order_data.qty,
             )
             return False
         elif order.filled_at is not None:
-            amountUpdate()
+            amountUpdate(order)
             logger.info(
-                f'Order filled for: {self.data["stock"]}, action: {self.data["action"]} {self.order_data.type._value_}, price: {self.data["price"]}, quantity: {self.order_data.qty}'
+                "Order filled for: %s, action: %s %s, price: %s, quantity: %s",
+                self.data["stock"],
+                self.data["action"],
+                self.order_data.type._value_,
+                self.data["price"],
+                self.order_data.qty,
             )
             return True
 
@@ -761,7 +1077,11 @@ class AutomatedTrader:
         for x in self.options["orders"]:
             self.client.cancel_order_by_id(x.id.hex)
             logger.info(
-                f'Canceled order for: {self.data["stock"]}, {self.data["action"]}, {self.data["position"]}, id: {x.id.hex}'
+                "Canceled order for: %s, %s, %s, id: %s",
+                self.data["stock"],
+                self.data["action"],
+                self.data["position"],
+                x.id.hex,
             )
 
     def cancelAll(self):
@@ -772,8 +1092,14 @@ class AutomatedTrader:
 if __name__ == "__main__":
     # Display general account info.
     acctInfo()
-    # Start the app with one thread to avoid overwriting preference file through get_stock_info.
-    threads = 1
+    # Listen for order updates on the accounts that can be traded on.
+    orderUpdates.start(client, account)
+    if settings["perStockPreference"]:
+        orderUpdates.start(clientReal, accountReal)
+        orderUpdates.start(clientPaper, accountPaper)
+    # Requests are only queued by the app (see workerThreads for processing them) so it can use more threads to
+    # handle bursts of alerts.
+    threads = 16
     try:
         if sys.argv[1] == "serveTV":
             serve(app, port=5000, threads=threads, host="0.0.0.0")
@@ -6,6 +6,9 @@ try:
 except ModuleNotFoundError:
     pass
 
+# Load the .env file once when imported. getKeys reads the keys from the environment after this.
+load_dotenv(override=True)
+
 
 def getKeys(account):
     """Retrives the keys for either the "paperTrading" or "realTrading" account.
@@ -15,7 +18,6 @@ def getKeys(account):
         "secret_key": "jkn23kj234nkj2",
         "paper": True,
     }"""
-    load_dotenv(override=True)
 
     def getSecureKeys():
         # Try to get secure keys if they exist.
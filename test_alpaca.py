@@ -1,6 +1,19 @@
-from AlpacaTVBridge import AutomatedTrader, getKeys, loadSettings
+from AlpacaTVBridge import (
+    AutomatedTrader,
+    OrderUpdates,
+    RateLimiter,
+    clearAccountCache,
+    getAccount,
+    getKeys,
+    loadSettings,
+    traderOptionsPaper,
+)
+from alpaca.trading.enums import OrderSide
 from filePath import filePath
-import unittest, os, json, pytest
+from types import SimpleNamespace
+from unittest.mock import patch
+import AlpacaTVBridge
+import unittest, os, json, pytest, time, uuid, copy, asyncio, threading
 
 try:
     from settings import options
@@ -141,7 +154,7 @@ class TestAlpaca(unittest.TestCase):
             newOptions={"enabled": False, "perStockPreference": False},
         )
         result.setData()
-        self.assertEqual(result.data["action"], "Bear")
+        self.assertEqual(result.data["action"], "bear")
         self.assertEqual(result.data["position"], None)
         self.assertEqual(result.data["stock"], "CLSK")
         self.assertEqual(result.data["price"], 4.015)
@@ -153,7 +166,7 @@ class TestAlpaca(unittest.TestCase):
             newOptions={"enabled": False, "perStockPreference": False},
         )
         result.setData()
-        self.assertEqual(result.data["action"], "Bull")
+        self.assertEqual(result.data["action"], "bull")
         self.assertEqual(result.data["position"], None)
         self.assertEqual(result.data["stock"], "CLSK")
         self.assertEqual(result.data["price"], 4.015)
@@ -165,9 +178,8 @@ class TestAlpaca(unittest.TestCase):
             newOptions={"enabled": False, "perStockPreference": False},
         )
         result.setData()
-        self.assertEqual(result.data["action"], "Open")
-        # self.assertEqual(result.data["position"], "Long")
-        self.assertEqual(result.data["position"], "Long".upper())
+        self.assertEqual(result.data["action"], "open")
+        self.assertEqual(result.data["position"], "long")
         self.assertEqual(result.data["stock"], "MSFT")
         self.assertEqual(result.data["price"], 327.3)
 
@@ -178,9 +190,8 @@ class TestAlpaca(unittest.TestCase):
             newOptions={"enabled": False, "perStockPreference": False},
         )
         result.setData()
-        self.assertEqual(result.data["action"], "Close")
-        # self.assertEqual(result.data["position"], "Long")
-        self.assertEqual(result.data["position"], "Long".upper())
+        self.assertEqual(result.data["action"], "close")
+        self.assertEqual(result.data["position"], "long")
         self.assertEqual(result.data["stock"], "CLSK")
         self.assertEqual(result.data["price"], 4.015)
 
@@ -191,9 +202,8 @@ class TestAlpaca(unittest.TestCase):
             newOptions={"enabled": False, "perStockPreference": False},
         )
         result.setData()
-        self.assertEqual(result.data["action"], "Open")
-        # self.assertEqual(result.data["position"], "Short")
-        self.assertEqual(result.data["position"], "Short".upper())
+        self.assertEqual(result.data["action"], "open")
+        self.assertEqual(result.data["position"], "short")
         self.assertEqual(result.data["stock"], "CLSK")
         self.assertEqual(result.data["price"], 4.015)
 
@@ -204,9 +214,46 @@ class TestAlpaca(unittest.TestCase):
             newOptions={"enabled": False, "perStockPreference": False},
         )
         result.setData()
-        self.assertEqual(result.data["action"], "Close")
-        # self.assertEqual(result.data["position"], "Short")
-        self.assertEqual(result.data["position"], "Short".upper())
+        self.assertEqual(result.data["action"], "close")
+        self.assertEqual(result.data["position"], "short")
+        self.assertEqual(result.data["stock"], "CLSK")
+        self.assertEqual(result.data["price"], 4.01)
+
+    def test_dataBytesLDC(self):
+        # Webhook requests are received as bytes.
+        result = AutomatedTrader(
+            paperTrading,
+            req=marketLDC["Open"].encode(),
+            newOptions={"enabled": False, "perStockPreference": False},
+        )
+        result.setData()
+        self.assertEqual(result.data["action"], "open")
+        self.assertEqual(result.data["position"], "long")
+        self.assertEqual(result.data["stock"], "MSFT")
+        self.assertEqual(result.data["price"], 327.3)
+
+    def test_dataBytesOrder(self):
+        result = AutomatedTrader(
+            paperTrading,
+            req=b"order sell | MSFT@337.57 | TEST",
+            newOptions={"enabled": False, "perStockPreference": False},
+        )
+        result.setData()
+        self.assertEqual(result.data["action"], "sell")
+        self.assertEqual(result.data["position"], None)
+        self.assertEqual(result.data["stock"], "MSFT")
+        self.assertEqual(result.data["price"], 337.57)
+
+    def test_dataWhitespace(self):
+        # Leading/trailing whitespace in the request body shouldn't prevent matching LDC alerts.
+        result = AutomatedTrader(
+            paperTrading,
+            req=b" \n" + marketLDC["Close"].encode() + b"\n",
+            newOptions={"enabled": False, "perStockPreference": False},
+        )
+        result.setData()
+        self.assertEqual(result.data["action"], "close")
+        self.assertEqual(result.data["position"], "short")
         self.assertEqual(result.data["stock"], "CLSK")
         self.assertEqual(result.data["price"], 4.01)
 
@@ -656,6 +703,288 @@ class TestAlpaca(unittest.TestCase):
     #     )
 
 
+def makeOrder(side=OrderSide.BUY, qty="2", filled=False):
+    # Order with only the fields verifyOrder uses.
+    return SimpleNamespace(
+        id=uuid.uuid4(),
+        client_order_id=uuid.uuid4().hex,
+        side=side,
+        qty=qty,
+        filled_qty=qty if filled else "0",
+        filled_avg_price="100" if filled else None,
+        filled_at="now" if filled else None,
+        failed_at=None,
+        canceled_at=None,
+    )
+
+
+class StubClient:
+    """Trading client that keeps orders in memory. Canceled orders are marked canceled and market orders are
+    filled right away unless disabled."""
+
+    def __init__(self, marketFills=True, fillOnCancel=False):
+        self.marketFills = marketFills
+        self.fillOnCancel = fillOnCancel
+        self.orders = {}
+        self.canceled = []
+        self.submitted = []
+
+    def add(self, order):
+        self.orders[order.client_order_id] = order
+        return order
+
+    def get_order_by_client_id(self, id):
+        return self.orders[id]
+
+    def cancel_order_by_id(self, id):
+        self.canceled.append(id)
+        for order in self.orders.values():
+            if order.id.hex == id and not OrderUpdates.done(order):
+                if self.fillOnCancel:
+                    # Order filled before the cancel went through.
+                    order.filled_at = "now"
+                    order.filled_qty = order.qty
+                    order.filled_avg_price = "100"
+                else:
+                    order.canceled_at = "now"
+
+    def submit_order(self, order_data):
+        self.submitted.append(order_data)
+        return self.add(
+            makeOrder(order_data.side, str(order_data.qty), self.marketFills)
+        )
+
+
+class StubUpdates:
+    """Stands in for the trade update stream using the orders in a StubClient."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def listening(self, tradingClient):
+        return True
+
+    def wait(self, id, timeout):
+        order = self.client.orders[id]
+        if OrderUpdates.done(order):
+            return order
+        time.sleep(timeout)
+        return None
+
+    def forget(self, id):
+        pass
+
+
+class TestVerifyOrder(unittest.TestCase):
+    # Runs verifyOrder's state machine against StubClient and StubUpdates so no keys or network are needed.
+
+    def trader(self, client, **newOptions):
+        trader = AutomatedTrader.__new__(AutomatedTrader)
+        trader.stockUpdater = None
+        trader.debug = False
+        trader.asset = None
+        trader.newOrders = {}
+        trader.client = client
+        trader.data = {"stock": "MSFT", "action": "buy", "position": None, "price": 100.0}
+        trader.options = dict(traderOptionsPaper)
+        trader.options.update(
+            {"enabled": True, "maxTime": 0.05, "totalMaxTime": 0.2, **newOptions}
+        )
+        trader.orderType(2, OrderSide.BUY, True)
+        return trader
+
+    def verify(self, client, order, **newOptions):
+        trader = self.trader(client, **newOptions)
+        with patch.object(AlpacaTVBridge, "orderUpdates", StubUpdates(client)):
+            return trader.verifyOrder(order)
+
+    def test_pendingDone(self):
+        client = StubClient()
+        order = makeOrder()
+        # The stream reports the order filled.
+        client.add(copy.copy(order)).filled_at = "now"
+        self.assertTrue(self.verify(client, order))
+        self.assertEqual(client.canceled, [])
+        self.assertEqual(client.submitted, [])
+
+    def test_pendingCancel(self):
+        client = StubClient()
+        order = client.add(makeOrder())
+        self.assertTrue(self.verify(client, order, buyTimeout="Cancel"))
+        self.assertEqual(client.canceled, [order.id.hex])
+        self.assertEqual(client.submitted, [])
+
+    def test_pendingCancelMarket(self):
+        client = StubClient()
+        order = client.add(makeOrder(qty="3"))
+        order.filled_qty = "1"
+        self.assertTrue(self.verify(client, order, buyTimeout="Market"))
+        self.assertEqual(client.canceled, [order.id.hex])
+        self.assertEqual(len(client.submitted), 1)
+        self.assertEqual(client.submitted[0].qty, 2)
+        with self.assertRaises(AttributeError):
+            client.submitted[0].limit_price
+
+    def test_filledOnCancelMarket(self):
+        # No market order is made for an order that filled instead of canceling.
+        client = StubClient(fillOnCancel=True)
+        order = client.add(makeOrder())
+        self.assertTrue(self.verify(client, order, buyTimeout="Market"))
+        self.assertEqual(client.canceled, [order.id.hex])
+        self.assertEqual(client.submitted, [])
+
+    def test_totalMaxTime(self):
+        # totalMaxTime less than maxTime (like the default settings) cancels without a market order.
+        client = StubClient()
+        order = client.add(makeOrder())
+        self.assertFalse(
+            self.verify(
+                client, order, buyTimeout="Market", maxTime=0.2, totalMaxTime=0.05
+            )
+        )
+        self.assertEqual(client.canceled, [order.id.hex])
+        self.assertEqual(client.submitted, [])
+
+    def test_marketNotDone(self):
+        client = StubClient(marketFills=False)
+        order = client.add(makeOrder())
+        self.assertFalse(self.verify(client, order, buyTimeout="Market"))
+        self.assertEqual(len(client.submitted), 1)
+        # Original order and the timed out market order are both canceled.
+        self.assertEqual(len(client.canceled), 2)
+        self.assertNotEqual(client.canceled[1], order.id.hex)
+
+
+class TestOrderUpdates(unittest.TestCase):
+    def update(self, updates, event, order):
+        asyncio.run(updates.tradeUpdate(SimpleNamespace(event=event, order=order)))
+
+    def test_waitFilled(self):
+        updates = OrderUpdates()
+        order = makeOrder(filled=True)
+        self.update(updates, "fill", order)
+        self.assertIs(updates.wait(order.client_order_id, 0.05), order)
+        updates.forget(order.client_order_id)
+        self.assertNotIn(order.client_order_id, updates.orders)
+
+    def test_waitTimeout(self):
+        # Orders that aren't done aren't returned.
+        updates = OrderUpdates()
+        order = makeOrder()
+        self.update(updates, "new", order)
+        start = time.monotonic()
+        self.assertIsNone(updates.wait(order.client_order_id, 0.05))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_maxOrders(self):
+        updates = OrderUpdates()
+        updates.maxOrders = 2
+        orders = [makeOrder() for _ in range(3)]
+        for order in orders:
+            self.update(updates, "new", order)
+        self.assertEqual(
+            list(updates.orders), [x.client_order_id for x in orders[1:]]
+        )
+
+    def test_fillClearsAccountCache(self):
+        client = TestAccountCache.Client()
+        getAccount(client)
+        self.update(OrderUpdates(), "new", makeOrder())
+        self.assertIn(client, AlpacaTVBridge.accountCache)
+        self.update(OrderUpdates(), "fill", makeOrder(filled=True))
+        self.assertNotIn(client, AlpacaTVBridge.accountCache)
+
+    def test_listening(self):
+        updates = OrderUpdates()
+        client = object()
+        self.assertFalse(updates.listening(client))
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait, daemon=True)
+        thread.start()
+        try:
+            stream = SimpleNamespace(_running=False)
+            updates.streams[client] = (stream, thread)
+            self.assertFalse(updates.listening(client))
+            stream._running = True
+            self.assertTrue(updates.listening(client))
+        finally:
+            stop.set()
+            thread.join()
+        # Stream thread stopped.
+        self.assertFalse(updates.listening(client))
+
+
+class TestWebhook(unittest.TestCase):
+    def test_queue(self):
+        # Requests are queued as the raw body and processed by the worker after responding.
+        release = threading.Event()
+        processed = []
+
+        def trader(req):
+            release.wait(5)
+            processed.append(req)
+            if len(processed) == 1:
+                raise Exception("test failure")
+
+        client = AlpacaTVBridge.app.test_client()
+        with patch.object(AlpacaTVBridge, "AutomatedTrader", side_effect=trader):
+            response = client.post("/", data=b"order buy | MSFT@233.41 | TEST")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(processed, [])
+            release.set()
+            AlpacaTVBridge.workQueue.join()
+            self.assertEqual(processed, [b"order buy | MSFT@233.41 | TEST"])
+            # Worker keeps running after an exception.
+            client.post("/", data=b"order sell | MSFT@233.41 | TEST")
+            AlpacaTVBridge.workQueue.join()
+        self.assertEqual(processed[1], b"order sell | MSFT@233.41 | TEST")
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_burst(self):
+        # A burst of 'rate' calls goes through right away, after that no more than 'rate' calls are allowed
+        # within any 'per' seconds.
+        rate, per = 5, 0.3
+        limiter = RateLimiter(rate, per)
+        start = time.monotonic()
+        times = []
+        for _ in range(rate * 3):
+            limiter.acquire()
+            # Time the call was allowed.
+            times.append(limiter.window[-1])
+        self.assertLess(times[rate - 1] - start, 0.05)
+        for i in range(len(times) - rate):
+            self.assertGreaterEqual(times[i + rate] - times[i], per)
+
+
+class TestAccountCache(unittest.TestCase):
+    class Client:
+        # Counts get_account calls. clearDuring clears the cache while the request is in progress.
+        def __init__(self, clearDuring=False):
+            self.calls = 0
+            self.clearDuring = clearDuring
+
+        def get_account(self):
+            self.calls += 1
+            if self.clearDuring:
+                clearAccountCache()
+            return SimpleNamespace(cash=str(self.calls))
+
+    def test_cached(self):
+        client = self.Client()
+        self.assertEqual(getAccount(client).cash, "1")
+        self.assertEqual(getAccount(client).cash, "1")
+        clearAccountCache()
+        self.assertEqual(getAccount(client).cash, "2")
+
+    def test_clearedDuringRequest(self):
+        # An account retrieved before the cache was cleared shouldn't be stored.
+        client = self.Client(clearDuring=True)
+        getAccount(client)
+        getAccount(client)
+        self.assertEqual(client.calls, 2)
+
+
 if __name__ == "__main__":
     # unittest.main()
     pytest.main()